@@ -2,9 +2,11 @@ from flask import Flask
 
 from service_api.models import db, Upload, Point, Distance, Task
 from service_api.resources.georevers import api
+from service_api.services.json_provider import OrjsonProvider
 from service_api.settings import DevelopmentConfig
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.register_blueprint(api)
 app.config.from_object(DevelopmentConfig)
 
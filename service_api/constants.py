@@ -1 +1,26 @@
-ALLOWED_EXTENSIONS = ("csv",)
+ALLOWED_EXTENSIONS = frozenset({"csv"})
+
+# Decimal places of the distances (in meters) computed on the workers.
+DISTANCE_DECIMALS = 1
+# Peak worker memory per point pair of insert_distances_numpy: pair indices, NumPy
+# temporaries and the Python lists streamed by COPY (measured with tracemalloc).
+DISTANCE_PAIR_BYTES = 136
+
+RESULT_CACHE_KEY = "result:{}"
+# Results are cached briefly while the tasks are running or failed (failed uploads are
+# retried) to absorb polling, and for long once they are completed (the cache is
+# invalidated on status changes).
+RUNNING_RESULT_CACHE_TIMEOUT = 5
+FINAL_RESULT_CACHE_TIMEOUT = 3600
+# Larger results (beyond ~1,200 points at ~42 bytes per link) are not cached.
+RESULT_CACHE_MAX_BYTES = 32 * 2**20
+
+# Reverse geocoded addresses are cached per cell of a lat/lon grid of
+# ADDRESS_CACHE_PRECISION decimal places (about 11 m), and shared by all the uploads.
+ADDRESS_CACHE_KEY = "geo:{}:{}"
+ADDRESS_CACHE_PRECISION = 4
+ADDRESS_CACHE_TIMEOUT = 30 * 24 * 3600
+
+# Set of the starts of the completed distance chunks of an upload, kept for a day at most.
+DISTANCE_CHUNKS_KEY = "distance_chunks:{}"
+DISTANCE_CHUNKS_TIMEOUT = 24 * 3600
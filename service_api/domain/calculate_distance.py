@@ -1,19 +1,31 @@
 import os
+from itertools import repeat
 
+import numpy as np
 from flask import current_app
+from sqlalchemy import select, text
 
+from service_api.constants import DISTANCE_DECIMALS, DISTANCE_PAIR_BYTES
 from service_api.models import Upload, db, Task, TaskStatus, TaskType
+from service_api.services.geo import (
+    GPU_AVAILABLE,
+    haversine_gpu,
+    haversine_pairs,
+    triu_pairs,
+)
+from service_api.services.pgcopy import copy_rows
+from service_api.services.utils import save_upload
 
 
-def save_file(file, upload_uuid):
+def save_file(file, upload_uuid, max_distance=None):
     # Generate a unique identifier for this upload.
 
     # Build the file path where the CSV file will be saved.
     save_path = os.path.join(current_app.config["UPLOAD_FOLDER"], f"{upload_uuid}.csv")
-    file.save(save_path)
+    save_upload(file, save_path)
 
     # Create a new Upload record with the generated UUID and the original filename.
-    upload = Upload(uuid=upload_uuid, filename=file.filename)
+    upload = Upload(uuid=upload_uuid, filename=file.filename, max_distance=max_distance)
     db.session.add(upload)
 
     # Create two Task records:
@@ -27,3 +39,165 @@ def save_file(file, upload_uuid):
     )
     db.session.add_all([reverse_task, distance_task])
     db.session.commit()
+
+
+def insert_distances_sql(upload_uuid, max_distance=None):
+    """
+    Generate the distance records for every unique pair of points of the upload with a single
+    INSERT ... SELECT: Postgres performs the self-join on the Point table and computes the
+    great-circle distance with earthdistance in the same plan, so no pair rows leave the database.
+    The ll_to_earth conversion is done once per point in the CTE rather than twice per pair.
+
+    When max_distance (in meters) is given, only the pairs within that distance are stored:
+    the join is bounded by an earth_box around each point, which is answered by the GiST
+    index on ll_to_earth(lat, lon), so about N*k candidate pairs are measured instead of N².
+    """
+    if max_distance is None:
+        query = text("""
+            WITH p AS (
+                SELECT id, upload_uuid, ll_to_earth(lat, lon) AS earth
+                FROM point
+                WHERE upload_uuid = :upload_uuid
+            )
+            INSERT INTO distance (point_a_id, point_b_id, distance, upload_uuid)
+            SELECT
+                a.id AS point_a_id,
+                b.id AS point_b_id,
+                earth_distance(a.earth, b.earth)::real AS distance,
+                a.upload_uuid
+            FROM p a
+            JOIN p b ON a.id < b.id;
+        """)
+    else:
+        # ll_to_earth(b.lat, b.lon) must match the expression of the ix_point_earth index.
+        query = text("""
+            INSERT INTO distance (point_a_id, point_b_id, distance, upload_uuid)
+            SELECT
+                a.id AS point_a_id,
+                b.id AS point_b_id,
+                earth_distance(
+                    ll_to_earth(a.lat, a.lon), ll_to_earth(b.lat, b.lon)
+                )::real AS distance,
+                a.upload_uuid
+            FROM point a
+            JOIN point b
+                ON earth_box(ll_to_earth(a.lat, a.lon), :max_distance)
+                    @> ll_to_earth(b.lat, b.lon)
+                AND b.upload_uuid = a.upload_uuid
+                AND a.id < b.id
+            WHERE a.upload_uuid = :upload_uuid
+                AND earth_distance(
+                    ll_to_earth(a.lat, a.lon), ll_to_earth(b.lat, b.lon)
+                ) <= :max_distance;
+        """)
+    db.session.execute(
+        query, {"upload_uuid": upload_uuid, "max_distance": max_distance}
+    )
+
+
+def get_max_distance(upload_uuid):
+    """Return the distance bound of the upload, in meters, None when all the pairs are kept."""
+    return db.session.scalar(
+        select(Upload.max_distance).where(Upload.uuid == upload_uuid)
+    )
+
+
+def count_points(upload_uuid):
+    """Return the number of points of the upload."""
+    return db.session.execute(
+        text("SELECT count(*) FROM point WHERE upload_uuid = :upload_uuid"),
+        {"upload_uuid": upload_uuid},
+    ).scalar_one()
+
+
+def distance_chunk_size():
+    """
+    Return the number of point pairs computed by each task of the NumPy backend:
+    DISTANCE_CHUNK_SIZE when it is set, otherwise as many as fit in DISTANCE_CHUNK_BYTES.
+    """
+    config = current_app.config
+    return config["DISTANCE_CHUNK_SIZE"] or max(
+        1, config["DISTANCE_CHUNK_BYTES"] // DISTANCE_PAIR_BYTES
+    )
+
+
+def insert_distances_numpy(upload_uuid, start, stop, max_distance=None):
+    """
+    Generate the distance records of the point pairs [start, stop) on the worker.
+    The coordinates of the upload are fetched with a single query and the distances of
+    the pairs are computed in one vectorized call before being streamed back with COPY.
+    Uploads with more than GPU_DISTANCE_THRESHOLD points are computed on the GPU when
+    cuspatial is available on the worker. Points sharing the same coordinates are only
+    measured once when that saves work.
+    When max_distance (in meters) is given, only the pairs within that distance are stored.
+    """
+    # The columns are aggregated into one row of three arrays, so no per-point row
+    # is built by the driver and each array is converted to NumPy in one call.
+    query = text("""
+        SELECT
+            array_agg(id ORDER BY id),
+            array_agg(lon ORDER BY id),
+            array_agg(lat ORDER BY id)
+        FROM point
+        WHERE upload_uuid = :upload_uuid
+    """)
+    point_ids, lons, lats = db.session.execute(
+        query, {"upload_uuid": upload_uuid}
+    ).one()
+    if point_ids is None or len(point_ids) < 2:
+        return
+
+    point_ids = np.array(point_ids, dtype=np.int64)
+    lons = np.array(lons, dtype=np.float64)
+    lats = np.array(lats, dtype=np.float64)
+
+    idx_a, idx_b = triu_pairs(len(point_ids), start, stop)
+
+    # Uploads often repeat the same positions: when the distinct positions have fewer
+    # pairs than the chunk, each of them is measured once and the pairs look them up.
+    positions, position_idx = np.unique(
+        np.column_stack((lons, lats)), axis=0, return_inverse=True
+    )
+    position_idx = position_idx.ravel()
+    positions_count = len(positions)
+    position_pairs_count = positions_count * (positions_count - 1) // 2
+    if position_pairs_count < stop - start:
+        pos_a, pos_b = triu_pairs(positions_count, 0, position_pairs_count)
+        matrix = np.zeros((positions_count, positions_count))
+        matrix[pos_a, pos_b] = _measure_pairs(
+            positions[:, 0], positions[:, 1], pos_a, pos_b
+        )
+        matrix[pos_b, pos_a] = matrix[pos_a, pos_b]
+        distances = matrix[position_idx[idx_a], position_idx[idx_b]]
+    else:
+        distances = _measure_pairs(lons, lats, idx_a, idx_b)
+
+    if max_distance is not None:
+        within = distances <= max_distance
+        idx_a, idx_b, distances = idx_a[within], idx_b[within], distances[within]
+
+    # Quantize the distances before they are serialized: a spherical earth model is off by
+    # far more than a decimeter, and the shortest repr of the rounded values is about half
+    # as long as the 17 significant digits of a raw float64, which shrinks the COPY stream.
+    distances = np.round(distances, DISTANCE_DECIMALS)
+
+    copy_rows(
+        db.session,
+        "distance",
+        ("point_a_id", "point_b_id", "distance", "upload_uuid"),
+        zip(
+            point_ids[idx_a].tolist(),
+            point_ids[idx_b].tolist(),
+            distances.tolist(),
+            repeat(upload_uuid),
+        ),
+    )
+
+
+def _measure_pairs(lons, lats, idx_a, idx_b):
+    # Large uploads are computed on the GPU when cuspatial is available on the worker.
+    if GPU_AVAILABLE and len(lons) > current_app.config["GPU_DISTANCE_THRESHOLD"]:
+        return haversine_gpu(lons[idx_a], lats[idx_a], lons[idx_b], lats[idx_b])
+    return haversine_pairs(
+        lons, lats, idx_a, idx_b, fast_math=current_app.config["FAST_MATH"]
+    )
@@ -1,37 +1,75 @@
-from service_api.models import Point, Distance, Task, TaskType, TaskStatus
+from flask import current_app
+from sqlalchemy.orm import selectinload
+
+from service_api.constants import (
+    FINAL_RESULT_CACHE_TIMEOUT,
+    RUNNING_RESULT_CACHE_TIMEOUT,
+)
+from service_api.models import db, Upload, Point, Distance, TaskType, TaskStatus
+from service_api.services.cache import cache_result, get_cached_result
 
 
 def get_result(upload_uuid):
-    points_data = _get_points_data(upload_uuid)
-    links_data = _get_links_data(upload_uuid)
-    tasks = _get_tasks(upload_uuid)
-    statuses_data = _extract_statuses(tasks)
-    overall_status = _determine_overall_status(tasks)
+    """
+    Return the result of the upload as a JSON payload (bytes), None for an unknown upload.
+    The result is serialized once, and the same payload is cached and served as is.
+    """
+    cached = get_cached_result(upload_uuid)
+    if cached is not None:
+        return cached
+
+    # Load the upload together with all of its collections: one statement for the upload
+    # and one batched SELECT ... WHERE upload_uuid IN (...) per relationship.
+    # Only the columns used below are selected. tests/test_get_result.py forbids lazy loads
+    # and bounds the number of statements, so N+1 queries fail the tests instead of a request.
+    upload = db.session.get(
+        Upload,
+        upload_uuid,
+        options=[
+            selectinload(Upload.points).load_only(Point.name, Point.address),
+            selectinload(Upload.distances).load_only(
+                Distance.point_a_id, Distance.point_b_id, Distance.distance
+            ),
+            selectinload(Upload.tasks),
+        ],
+    )
+    if upload is None:
+        return None
+
+    points_data = _get_points_data(upload)
+    links_data = _get_links_data(upload)
+    statuses_data = _extract_statuses(upload.tasks)
+    overall_status = _determine_overall_status(upload.tasks)
 
-    return {
+    result = {
         "task_id": upload_uuid,
         "status": overall_status,
         "data": {"points": points_data, "links": links_data},
         "statuses": statuses_data,
     }
+    timeout = (
+        FINAL_RESULT_CACHE_TIMEOUT
+        if overall_status == "completed"
+        else RUNNING_RESULT_CACHE_TIMEOUT
+    )
+    payload = current_app.json.dumps(result).encode()
+    cache_result(upload_uuid, payload, timeout)
+    return payload
 
 
-def _get_points_data(upload_uuid):
-    points = Point.query.filter_by(upload_uuid=upload_uuid).all()
-    return [{"name": point.name, "address": point.address} for point in points]
+def _get_points_data(upload):
+    return [{"name": point.name, "address": point.address} for point in upload.points]
 
 
-def _get_links_data(upload_uuid):
-    distances = Distance.query.filter_by(upload_uuid=upload_uuid).all()
+def _get_links_data(upload):
+    # Distances reference their points by id, the names come from the loaded points.
+    names = {point.id: point.name for point in upload.points}
     return [
-        {"name": f"{d.name_a}{d.name_b}", "distance": d.distance} for d in distances
+        {"name": f"{names[d.point_a_id]}{names[d.point_b_id]}", "distance": d.distance}
+        for d in upload.distances
     ]
 
 
-def _get_tasks(upload_uuid):
-    return Task.query.filter_by(upload_uuid=upload_uuid).all()
-
-
 def _extract_statuses(tasks):
     statuses = {}
     for task in tasks:
@@ -43,8 +81,10 @@ def _extract_statuses(tasks):
 
 
 def _determine_overall_status(tasks):
-    if any(t.status == TaskStatus.failed for t in tasks):
-        return "failed"
-    elif all(t.status == TaskStatus.completed for t in tasks) and tasks:
-        return "completed"
-    return "running"
+    # Single pass: any failed task fails the upload, otherwise every task must be completed.
+    all_completed = bool(tasks)
+    for task in tasks:
+        if task.status == TaskStatus.failed:
+            return "failed"
+        all_completed = all_completed and task.status == TaskStatus.completed
+    return "completed" if all_completed else "running"
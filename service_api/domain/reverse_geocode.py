@@ -0,0 +1,66 @@
+import asyncio
+
+from flask import current_app
+from sqlalchemy import text
+
+from service_api.constants import ADDRESS_CACHE_PRECISION
+from service_api.models import db
+from service_api.services.cache import cache_addresses, get_cached_addresses
+from service_api.services.geo import reverse_geocode_batch
+from service_api.services.pgcopy import copy_rows
+
+
+def geocode_addresses(lats, lons):
+    """
+    Return the addresses of the given points, in the same order.
+    The points are snapped to a grid of ADDRESS_CACHE_PRECISION decimal places and each
+    cell is looked up once: the cached cells are fetched from Redis with a single MGET,
+    and only the others are reverse geocoded, then cached for the following batches.
+    """
+    cells = [
+        (round(lat, ADDRESS_CACHE_PRECISION), round(lon, ADDRESS_CACHE_PRECISION))
+        for lat, lon in zip(lats, lons)
+    ]
+    unique_cells = list(dict.fromkeys(cells))
+    addresses = dict(zip(unique_cells, get_cached_addresses(unique_cells)))
+
+    misses = [cell for cell, address in addresses.items() if address is None]
+    if misses:
+        geocoded = asyncio.run(
+            reverse_geocode_batch(
+                misses,
+                concurrency=current_app.config["GEOCODER_CONCURRENCY"],
+                rate=current_app.config["GEOCODER_RATE_LIMIT"],
+            )
+        )
+        addresses.update(zip(misses, geocoded))
+        # Failed lookups (None) are not cached, so that they are retried next time.
+        cache_addresses(
+            {
+                cell: address
+                for cell, address in zip(misses, geocoded)
+                if address is not None
+            }
+        )
+
+    return [addresses[cell] for cell in cells]
+
+
+def save_addresses(point_ids, addresses):
+    """
+    Store the addresses of the points within the session transaction.
+    The rows are streamed with COPY into a temporary table, dropped on commit, and applied
+    with a single UPDATE ... FROM join instead of one UPDATE statement per point.
+    """
+    db.session.execute(
+        text(
+            "CREATE TEMP TABLE point_address (id integer, address text) ON COMMIT DROP"
+        )
+    )
+    copy_rows(db.session, "point_address", ("id", "address"), zip(point_ids, addresses))
+    db.session.execute(
+        text(
+            "UPDATE point SET address = point_address.address "
+            "FROM point_address WHERE point.id = point_address.id"
+        )
+    )
@@ -3,8 +3,7 @@ import uuid
 from uuid import UUID
 
 from flask_sqlalchemy import SQLAlchemy
-from geoalchemy2 import Geography
-from sqlalchemy import ForeignKey
+from sqlalchemy import DDL, ForeignKey, event, func
 from sqlalchemy.orm import DeclarativeBase, Mapped, relationship, mapped_column
 
 
@@ -14,6 +13,16 @@ class Base(DeclarativeBase):
 
 db = SQLAlchemy(model_class=Base)
 
+# Great-circle distances are computed with `earthdistance`, which depends on `cube`.
+event.listen(
+    db.metadata,
+    "before_create",
+    DDL(
+        "CREATE EXTENSION IF NOT EXISTS cube; "
+        "CREATE EXTENSION IF NOT EXISTS earthdistance"
+    ),
+)
+
 
 class TaskStatus(enum.StrEnum):
     pending = enum.auto()
@@ -30,36 +39,75 @@ class TaskType(enum.StrEnum):
 class Upload(db.Model):
     uuid: Mapped[UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
     filename: Mapped[str]
+    # Only the pairs of points within this distance, in meters, are stored (all when None).
+    max_distance: Mapped[float | None]
 
-    points: Mapped[list["Point"]] = relationship("Point", backref="upload", lazy=True)
+    points: Mapped[list["Point"]] = relationship(
+        "Point", back_populates="upload", lazy="selectin"
+    )
     distances: Mapped[list["Distance"]] = relationship(
-        "Distance", backref="upload", lazy=True
+        "Distance", back_populates="upload", lazy="selectin"
     )
-    task: Mapped["Task"] = relationship("Task", backref="upload", uselist=False)
+    tasks: Mapped[list["Task"]] = relationship("Task", back_populates="upload")
 
 
 class Point(db.Model):
+    # Serves both the `upload_uuid = :u` lookups and the `a.id < b.id` self-join
+    # of a single upload as an index range scan.
+    __table_args__ = (db.Index("ix_point_upload_id", "upload_uuid", "id"),)
+
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(nullable=False)
-    geom: Mapped[Geography] = mapped_column(
-        Geography(geometry_type="POINT", srid=4326), nullable=False
-    )
+    lat: Mapped[float] = mapped_column(nullable=False)
+    lon: Mapped[float] = mapped_column(nullable=False)
     upload_uuid: Mapped[UUID] = mapped_column(ForeignKey("upload.uuid"), nullable=False)
     address: Mapped[str] = mapped_column(nullable=True)
 
+    upload: Mapped["Upload"] = relationship("Upload", back_populates="points")
+
+
+# GiST index on the points' position on the earth for earth_box / earth_distance lookups.
+db.Index(
+    "ix_point_earth",
+    func.ll_to_earth(Point.lat, Point.lon),
+    postgresql_using="gist",
+)
+
 
 class Distance(db.Model):
-    id: Mapped[int] = mapped_column(primary_key=True)
-    name_a: Mapped[str] = mapped_column(db.String, nullable=False)
-    name_b: Mapped[str] = mapped_column(db.String, nullable=False)
-    point_a: Mapped[str] = mapped_column(
-        Geography(geometry_type="POINT", srid=4326), nullable=False
-    )
-    point_b: Mapped[str] = mapped_column(
-        Geography(geometry_type="POINT", srid=4326), nullable=False
+    # Hash partitioned by upload, so that concurrent uploads write to different partitions
+    # and indexes, and the queries of an upload are pruned to its partition.
+    # The primary key of a partitioned table must contain the partition key.
+    __table_args__ = {"postgresql_partition_by": "HASH (upload_uuid)"}
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    # The pair references its points instead of copying their names and geographies
+    # into each of the N*(N-1)/2 rows of an upload.
+    point_a_id: Mapped[int] = mapped_column(ForeignKey("point.id"), nullable=False)
+    point_b_id: Mapped[int] = mapped_column(ForeignKey("point.id"), nullable=False)
+    # Single precision is plenty for distances in meters and halves the storage of the
+    # N*(N-1)/2 rows of an upload.
+    distance: Mapped[float] = mapped_column(db.REAL, nullable=True)
+    upload_uuid: Mapped[UUID] = mapped_column(
+        ForeignKey("upload.uuid"), primary_key=True, index=True
     )
-    distance: Mapped[float] = mapped_column(nullable=True)
-    upload_uuid: Mapped[UUID] = mapped_column(ForeignKey("upload.uuid"), nullable=False)
+
+    upload: Mapped["Upload"] = relationship("Upload", back_populates="distances")
+
+
+DISTANCE_PARTITIONS = 16
+
+event.listen(
+    Distance.__table__,
+    "after_create",
+    DDL(
+        "; ".join(
+            f"CREATE TABLE distance_p{remainder} PARTITION OF distance "
+            f"FOR VALUES WITH (MODULUS {DISTANCE_PARTITIONS}, REMAINDER {remainder})"
+            for remainder in range(DISTANCE_PARTITIONS)
+        )
+    ),
+)
 
 
 class Task(db.Model):
@@ -68,4 +116,8 @@ class Task(db.Model):
         default=TaskStatus.pending, nullable=False
     )
     task_type: Mapped[TaskType] = mapped_column(nullable=False)
-    upload_uuid: Mapped[UUID] = mapped_column(ForeignKey("upload.uuid"), nullable=False)
+    upload_uuid: Mapped[UUID] = mapped_column(
+        ForeignKey("upload.uuid"), nullable=False, index=True
+    )
+
+    upload: Mapped["Upload"] = relationship("Upload", back_populates="tasks")
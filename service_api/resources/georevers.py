@@ -1,14 +1,15 @@
-import csv
+import math
 import os
 from uuid import uuid4
 
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, stream_with_context
+from psycopg2.extras import execute_values
 from sqlalchemy import text
 
 from service_api.domain.calculate_distance import save_file
 from service_api.domain.get_result import get_result
-from service_api.models import Upload, db, Point
-from service_api.services.utils import allowed_file
+from service_api.models import Upload, db
+from service_api.services.utils import allowed_file, read_points, save_upload
 
 api = Blueprint("api", __name__, url_prefix="/api")
 
@@ -25,11 +26,11 @@ def calculate_distance_in_runtime():
       2. Generate a unique upload ID (upload_uuid) and save the file locally.
       3. Create an Upload record in the database.
       4. Parse the CSV file and bulk insert its rows into the Point table.
-      5. Immediately execute a PostGIS query via SQLAlchemy that:
+      5. Immediately execute an earthdistance query via SQLAlchemy that:
          - Performs a self-join on the Point table for the given upload_uuid to generate unique point pairs,
-         - Calculates the pairwise distance using PostGIS's ST_Distance function,
+         - Calculates the pairwise distance using the earth_distance function,
          - Concatenates the point names (with a dash) to form a combination name.
-      6. Return the computed combinations and distances as a JSON response.
+      6. Stream the computed combinations and distances back as a JSON response.
 
     Expected CSV format:
       Point,Latitude,Longitude
@@ -52,56 +53,68 @@ def calculate_distance_in_runtime():
     # Generate a unique UUID for this upload and save the file to the UPLOAD_FOLDER
     upload_uuid = uuid4()
     save_path = os.path.join(current_app.config["UPLOAD_FOLDER"], f"{upload_uuid}.csv")
-    file.save(save_path)
+    save_upload(file, save_path)
 
     # Create a new Upload record in the database
     upload = Upload(uuid=upload_uuid, filename=file.filename)
     db.session.add(upload)
     db.session.commit()  # Commit immediately to persist the upload record
 
-    # Read the CSV file and prepare the data for bulk insertion into the Point table
-    points_to_insert = []
-    with open(save_path, "r") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            point_name = row["Point"]
-            lat = float(row["Latitude"])
-            lon = float(row["Longitude"])
-            # Geometry is stored as WKT in the format: "POINT(lon lat)"
-            points_to_insert.append(
-                {
-                    "name": point_name,
-                    "geom": f"POINT({lon} {lat})",
-                    "upload_uuid": str(upload_uuid),
-                }
-            )
-
-    if points_to_insert:
-        db.session.bulk_insert_mappings(Point, points_to_insert)
-        db.session.commit()
-
-    # Use a PostGIS-enabled SQL query to generate point combinations with distances.
+    # Read the CSV file and feed its rows straight into multi-row INSERT statements,
+    # so no intermediate list of dicts is created in Python.
+    rows = (
+        (name, lat, lon, str(upload_uuid)) for name, lat, lon in read_points(save_path)
+    )
+    cursor = db.session.connection().connection.cursor()
+    try:
+        execute_values(
+            cursor,
+            "INSERT INTO point (name, lat, lon, upload_uuid) VALUES %s",
+            rows,
+            page_size=1000,
+        )
+    finally:
+        cursor.close()
+    db.session.commit()
+
+    # Use an earthdistance-enabled SQL query to generate point combinations with distances.
     # The query performs a self-join on the Point table (for the given upload_uuid) so that
     # each unique pair of points (e.g., A-B, A-C, B-C) is generated.
     # It concatenates the two point names (with a dash in between) as 'combination' and
-    # calculates the distance between the two points with ST_Distance.
+    # calculates the great-circle distance between the two points with earth_distance.
+    # The points are converted with ll_to_earth once in the CTE instead of once per pair.
     query = text("""
-        SELECT 
+        WITH p AS (
+            SELECT id, name, ll_to_earth(lat, lon) AS earth
+            FROM point
+            WHERE upload_uuid = :upload_uuid
+        )
+        SELECT
             a.name || b.name AS combination,
-            ST_Distance(a.geom, b.geom) AS distance
-        FROM point a
-        JOIN point b ON a.id < b.id
-        WHERE a.upload_uuid = :upload_uuid
-    """)
+            earth_distance(a.earth, b.earth) AS distance
+        FROM p a
+        JOIN p b ON a.id < b.id
+    """).execution_options(yield_per=1000)
     result = db.session.execute(query, {"upload_uuid": str(upload_uuid)})
 
-    # Process the query results into a list of dictionaries
-    combinations = []
-    for row in result:
-        combinations.append({"combination": row.combination, "distance": row.distance})
+    # Stream the combinations from the server-side cursor in chunks of `yield_per` rows
+    # instead of materializing all N*(N-1)/2 rows in memory before serializing them.
+    # Each chunk is serialized with a single call, the rows are already keyed by the
+    # query's `combination` and `distance` column names.
+    dumps = current_app.json.dumps
+
+    def generate():
+        yield f'{{"upload_uuid": {dumps(str(upload_uuid))}, "combinations": ['
+        separator = ""
+        for rows in result.partitions():
+            yield separator + dumps([row._asdict() for row in rows])[1:-1]
+            separator = ","
+        yield "]}"
 
     # Return a JSON response containing the upload_uuid and the generated combinations with distances.
-    return jsonify({"upload_uuid": str(upload_uuid), "combinations": combinations}), 200
+    return current_app.response_class(
+        stream_with_context(generate()), mimetype="application/json"
+    ), 200
 
 
 @api.route("/calculateDistances", methods=["POST"])
@@ -110,6 +123,8 @@ def calculate_distance():
     POST /api/calculateDistances
 
     This endpoint receives a CSV file containing point data and initiates the processing tasks.
+    An optional `max_distance` form field (in meters) limits the stored distances to the pairs
+    of points within that distance.
     The process is as follows:
       1. Validate the incoming file.
       2. Generate a unique upload identifier (upload_uuid) and save the CSV file locally.
@@ -134,31 +149,43 @@ def calculate_distance():
     if file.filename == "":
         return jsonify({"error": "No file selected"}), 400
 
-    # Validate the file using the allowed_file function.
-    if file and allowed_file(file.filename):
-        upload_uuid = uuid4()
+    # Validate the file type before any filesystem or database work.
+    if not allowed_file(file.filename):
+        return jsonify({"error": "Invalid file"}), 400
+
+    # Optional bound, in meters, on the distance of the pairs to store.
+    # A blank field, as sent by HTML forms for an unset value, is the same as no field.
+    max_distance = request.form.get("max_distance", "").strip() or None
+    if max_distance is not None:
+        try:
+            max_distance = float(max_distance)
+        except ValueError:
+            max_distance = None
+        if max_distance is None or not (
+            math.isfinite(max_distance) and max_distance > 0
+        ):
+            return jsonify({"error": "Invalid max_distance"}), 400
 
-        save_file(file, upload_uuid)
+    upload_uuid = uuid4()
 
-        # Lazy import to avoid circular dependency issues.
-        from service_api.tasks import process_file_tasks
+    save_file(file, upload_uuid, max_distance)
 
-        # Launch the processing task asynchronously.
-        process_file_tasks.delay()
+    # Lazy import to avoid circular dependency issues.
+    from service_api.tasks import process_file_tasks
 
-        return jsonify(
-            {
-                "message": "File uploaded and tasks created successfully",
-                "upload_uuid": str(upload_uuid),
-                "task_status": "pending",
-            }
-        ), 200
+    # Launch the processing task asynchronously.
+    process_file_tasks.delay()
 
-    # If the file is not allowed (i.e. the file type is invalid), return an error.
-    return jsonify({"error": "Invalid file"}), 400
+    return jsonify(
+        {
+            "message": "File uploaded and tasks created successfully",
+            "upload_uuid": str(upload_uuid),
+            "task_status": "pending",
+        }
+    ), 200
 
 
-@api.route("/getResult/<upload_uuid>", methods=["GET"])
+@api.route("/getResult/<uuid:upload_uuid>", methods=["GET"], strict_slashes=False)
 def get_file_result(upload_uuid):
     """
     GET /api/getResult/<upload_uuid>
@@ -195,7 +222,12 @@ def get_file_result(upload_uuid):
       - 'running' otherwise.
 
     Note: This endpoint uses the upload_uuid as the task ID.
+    The upload_uuid is parsed once by the route's `uuid` converter, so malformed values
+    and unknown uploads both return a 404 error.
     """
-    result = get_result(upload_uuid)
+    payload = get_result(upload_uuid)
+    if payload is None:
+        return jsonify({"error": "Upload not found"}), 404
 
-    return jsonify(result), 200
+    # The result is already serialized, cached results are served without any JSON work.
+    return current_app.response_class(payload, mimetype="application/json"), 200
@@ -0,0 +1,105 @@
+import redis
+from flask import current_app
+from loguru import logger
+
+from service_api.constants import (
+    ADDRESS_CACHE_KEY,
+    ADDRESS_CACHE_TIMEOUT,
+    DISTANCE_CHUNKS_KEY,
+    DISTANCE_CHUNKS_TIMEOUT,
+    RESULT_CACHE_KEY,
+    RESULT_CACHE_MAX_BYTES,
+)
+
+
+def get_redis():
+    """
+    Return the Redis client of the current application, creating it on first use
+    so that its connection pool is shared by all the requests and tasks of the process.
+    """
+    client = current_app.extensions.get("redis")
+    if client is None:
+        client = redis.Redis.from_url(current_app.config["CACHE_REDIS_URL"])
+        current_app.extensions["redis"] = client
+    return client
+
+
+def get_cached_result(upload_uuid):
+    """Return the cached JSON payload, None when it is missing or Redis is unavailable."""
+    try:
+        return get_redis().get(RESULT_CACHE_KEY.format(upload_uuid))
+    except redis.RedisError as e:
+        logger.warning("Result cache read failed for {}: {}", upload_uuid, e)
+        return None
+
+
+def cache_result(upload_uuid, payload, timeout):
+    """
+    Cache the JSON payload of a result, unless it is larger than RESULT_CACHE_MAX_BYTES.
+    The cache is best effort: a Redis error is logged and the result is still served.
+    """
+    if len(payload) > RESULT_CACHE_MAX_BYTES:
+        return
+    try:
+        get_redis().set(RESULT_CACHE_KEY.format(upload_uuid), payload, ex=timeout)
+    except redis.RedisError as e:
+        logger.warning("Result cache write failed for {}: {}", upload_uuid, e)
+
+
+def invalidate_result(*upload_uuids):
+    """
+    Drop the cached results, to be called whenever the status of their tasks changes.
+    A Redis error is only logged: the cached results expire after their timeout anyway,
+    and the work already committed by the caller must not be retried because of it.
+    """
+    if not upload_uuids:
+        return
+    try:
+        get_redis().delete(*(RESULT_CACHE_KEY.format(u) for u in upload_uuids))
+    except redis.RedisError as e:
+        logger.warning("Result cache invalidation failed for {}: {}", upload_uuids, e)
+
+
+def get_cached_addresses(cells):
+    """
+    Return the cached addresses of the (lat, lon) grid cells, None for the misses.
+    Every cell is a miss when Redis is unavailable, the addresses are then geocoded.
+    """
+    if not cells:
+        return []
+    try:
+        payloads = get_redis().mget([ADDRESS_CACHE_KEY.format(*cell) for cell in cells])
+    except redis.RedisError as e:
+        logger.warning("Address cache read failed: {}", e)
+        return [None] * len(cells)
+    return [None if payload is None else payload.decode() for payload in payloads]
+
+
+def cache_addresses(addresses):
+    """Cache the addresses of a {(lat, lon): address} mapping of grid cells, best effort."""
+    pipeline = get_redis().pipeline(transaction=False)
+    for cell, address in addresses.items():
+        pipeline.set(ADDRESS_CACHE_KEY.format(*cell), address, ex=ADDRESS_CACHE_TIMEOUT)
+    try:
+        pipeline.execute()
+    except redis.RedisError as e:
+        logger.warning("Address cache write failed: {}", e)
+
+
+def reset_done_chunks(upload_uuid):
+    get_redis().delete(DISTANCE_CHUNKS_KEY.format(upload_uuid))
+
+
+def count_done_chunk(upload_uuid, start):
+    """
+    Record the distance chunk of the upload starting at the pair `start` as completed
+    and return the number of completed chunks so far. Recording the same chunk again
+    does not change the count, so a failed call can be retried.
+    """
+    key = DISTANCE_CHUNKS_KEY.format(upload_uuid)
+    pipeline = get_redis().pipeline()
+    pipeline.sadd(key, start)
+    pipeline.expire(key, DISTANCE_CHUNKS_TIMEOUT)
+    pipeline.scard(key)
+    _, _, done = pipeline.execute()
+    return done
@@ -1,14 +1,40 @@
+import asyncio
+import math
+from functools import lru_cache
+
 import numpy as np
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut, GeocoderServiceError
 
+try:
+    # Only installed on CUDA workers (RAPIDS), the CPU path is used otherwise.
+    import cuspatial
+except ImportError:
+    cuspatial = None
+
+GPU_AVAILABLE = cuspatial is not None
+
+try:
+    # Installed by the "jit" dependency group (worker image), NumPy is used otherwise.
+    import numba
+except ImportError:
+    numba = None
+
+JIT_AVAILABLE = numba is not None
+
+# Earth radius used by haversine_np, in meters.
+EARTH_RADIUS = 6378137
+# Earth radius used by cuspatial.haversine_distance, in kilometers.
+CUSPATIAL_EARTH_RADIUS_KM = 6371
+
 
 def haversine_np(lon1, lat1, lon2, lat2):
     """
     Calculate the great circle distance between two points
     on the earth (specified in decimal degrees)
 
-    All args must be of equal length.
+    All args must be of equal length (or broadcastable),
+    the distances in meters are returned as an array of the same shape.
 
     """
     lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
@@ -19,8 +45,133 @@ def haversine_np(lon1, lat1, lon2, lat2):
     a = np.sin(dlat / 2.0) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2.0) ** 2
 
     c = 2 * np.arcsin(np.sqrt(a))
-    meters = 6378137 * c
-    return float(meters)
+    meters = EARTH_RADIUS * c
+    return meters
+
+
+def haversine_pairs(lons, lats, idx_a, idx_b, fast_math=False):
+    """
+    Same as haversine_np for the pairs (idx_a[k], idx_b[k]) of the given points.
+    The radians conversion and cos(lat) are computed once per point and gathered for
+    the pairs, so only the sines, the square root and the arcsine are computed per pair.
+    When numba is available the pairs are computed by a compiled loop spread over the
+    numba threads, without allocating the intermediate arrays of the NumPy expression.
+
+    With fast_math, both paths expand the half-angle sines with the per-point sines
+    and cosines, hav(d) = (1 - cos(d)) / 2 and cos(b - a) = cos a cos b + sin a sin b,
+    leaving no trigonometric call per pair but the arcsine. The subtraction from 1 loses
+    precision on close points: distances under ~10 m can be off by up to ~10 cm.
+    """
+    lons = np.radians(lons)
+    lats = np.radians(lats)
+    cos_lats = np.cos(lats)
+    if fast_math:
+        sin_lats = np.sin(lats)
+        sin_lons = np.sin(lons)
+        cos_lons = np.cos(lons)
+    else:
+        # The per-point sines and cosines are only read with fast_math.
+        sin_lats = sin_lons = cos_lons = np.empty(0)
+
+    if JIT_AVAILABLE:
+        distances = np.empty(len(idx_a), dtype=np.float64)
+        _haversine_pairs_jit(
+            lons,
+            lats,
+            cos_lats,
+            sin_lats,
+            sin_lons,
+            cos_lons,
+            idx_a,
+            idx_b,
+            fast_math,
+            distances,
+        )
+        return distances
+
+    if fast_math:
+        cos_lats_ab = cos_lats[idx_a] * cos_lats[idx_b]
+        cos_dlat = cos_lats_ab + sin_lats[idx_a] * sin_lats[idx_b]
+        cos_dlon = cos_lons[idx_a] * cos_lons[idx_b] + sin_lons[idx_a] * sin_lons[idx_b]
+        a = (1.0 - cos_dlat + cos_lats_ab * (1.0 - cos_dlon)) / 2.0
+        # Rounding can push a slightly out of the domain of the square root and arcsine.
+        np.clip(a, 0.0, 1.0, out=a)
+    else:
+        dlon = lons[idx_b] - lons[idx_a]
+        dlat = lats[idx_b] - lats[idx_a]
+
+        a = (
+            np.sin(dlat / 2.0) ** 2
+            + cos_lats[idx_a] * cos_lats[idx_b] * np.sin(dlon / 2.0) ** 2
+        )
+
+    c = 2 * np.arcsin(np.sqrt(a))
+    return EARTH_RADIUS * c
+
+
+if JIT_AVAILABLE:
+    # cache=True keeps the machine code in __pycache__, so the worker processes and
+    # restarts load it from disk instead of compiling it again.
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _haversine_pairs_jit(
+        lons, lats, cos_lats, sin_lats, sin_lons, cos_lons, idx_a, idx_b, fast_math, out
+    ):
+        # lons and lats are in radians, out receives the distances in meters.
+        for k in numba.prange(out.size):
+            i = idx_a[k]
+            j = idx_b[k]
+            if fast_math:
+                cos_lats_ab = cos_lats[i] * cos_lats[j]
+                cos_dlat = cos_lats_ab + sin_lats[i] * sin_lats[j]
+                cos_dlon = cos_lons[i] * cos_lons[j] + sin_lons[i] * sin_lons[j]
+                a = (1.0 - cos_dlat + cos_lats_ab * (1.0 - cos_dlon)) / 2.0
+                a = min(max(a, 0.0), 1.0)
+            else:
+                sin_dlat = math.sin((lats[j] - lats[i]) / 2.0)
+                sin_dlon = math.sin((lons[j] - lons[i]) / 2.0)
+                a = sin_dlat**2 + cos_lats[i] * cos_lats[j] * sin_dlon**2
+            out[k] = EARTH_RADIUS * 2 * math.asin(math.sqrt(a))
+
+
+def init_jit_worker():
+    """
+    Prepare the JIT kernel in a Celery worker process. The prefork pool already runs
+    one process per core, so the kernel is limited to a single thread per process to
+    avoid oversubscribing the CPUs. It is then compiled for the argument types used by
+    the distance tasks, or loaded from the on-disk cache, ahead of the first task.
+    """
+    if JIT_AVAILABLE:
+        numba.set_num_threads(1)
+        idx_a, idx_b = triu_pairs(2, 0, 1)
+        haversine_pairs(np.zeros(2), np.zeros(2), idx_a, idx_b)
+
+
+def haversine_gpu(lon1, lat1, lon2, lat2):
+    """
+    Same as haversine_np, computed on the GPU with cuspatial.
+    The coordinates are copied to the device once and the distances of all the pairs
+    are computed in parallel, the result is returned as a host array in meters.
+    """
+    points_a = cuspatial.GeoSeries.from_points_xy(np.column_stack((lon1, lat1)).ravel())
+    points_b = cuspatial.GeoSeries.from_points_xy(np.column_stack((lon2, lat2)).ravel())
+    kilometers = cuspatial.haversine_distance(points_a, points_b).values_host
+    # Rescale to the radius used by haversine_np so both paths return the same distances.
+    return kilometers * (EARTH_RADIUS / CUSPATIAL_EARTH_RADIUS_KM)
+
+
+def triu_pairs(n, start, stop):
+    """
+    Return the (row, column) indices of the pairs [start, stop) of the upper triangle
+    of an n x n matrix, in the same row-major order as `np.triu_indices(n, k=1)`,
+    without materializing the indices of the other pairs.
+    """
+    rows = np.arange(n, dtype=np.int64)
+    # Number of pairs preceding each row of the upper triangle.
+    row_offsets = rows * n - rows * (rows + 1) // 2
+    pairs = np.arange(start, stop, dtype=np.int64)
+    idx_a = np.searchsorted(row_offsets, pairs, side="right") - 1
+    idx_b = pairs - row_offsets[idx_a] + idx_a + 1
+    return idx_a, idx_b
 
 
 def reverse_geocode(lat, lon, language="ru", user_agent="my_geocoder"):
@@ -34,7 +185,7 @@ def reverse_geocode(lat, lon, language="ru", user_agent="my_geocoder"):
     :param user_agent: The application identifier for the geocoding service.
     :return: A human-readable address or an error message.
     """
-    geolocator = Nominatim(user_agent=user_agent)
+    geolocator = _get_geolocator(user_agent)
     try:
         # Execute a reverse geocoding request.
         # The language parameter can be set to return the address in the desired language.
@@ -47,3 +198,50 @@ def reverse_geocode(lat, lon, language="ru", user_agent="my_geocoder"):
         # Handle errors, for example, in case of timeout or other service issues.
         print("Geocoding error:", e)
         return None
+
+
+async def reverse_geocode_batch(coordinates, concurrency=10, rate=1.0, **kwargs):
+    """
+    This function reverse geocodes many points concurrently.
+    Up to `concurrency` requests are in flight at the same time, while their start times
+    are spaced so that no more than `rate` requests per second are sent to the service.
+
+    :param coordinates: An iterable of (lat, lon) tuples.
+    :param concurrency: The maximum number of simultaneous requests.
+    :param rate: The maximum number of requests started per second.
+    :param kwargs: Extra arguments passed to reverse_geocode (language, user_agent).
+    :return: The list of addresses, in the order of the given coordinates.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = _RateLimiter(rate)
+
+    async def geocode(lat, lon):
+        async with semaphore:
+            await limiter.wait()
+            # geopy's client is blocking, so the request itself runs in a worker thread.
+            return await asyncio.to_thread(reverse_geocode, lat, lon, **kwargs)
+
+    return await asyncio.gather(*(geocode(lat, lon) for lat, lon in coordinates))
+
+
+class _RateLimiter:
+    """Spaces the callers of `wait` at least `1 / rate` seconds apart."""
+
+    def __init__(self, rate):
+        self._interval = 1.0 / rate
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            delay = self._next_slot - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_slot = loop.time() + self._interval
+
+
+@lru_cache
+def _get_geolocator(user_agent):
+    # The geocoder is reused across calls instead of being rebuilt for every point.
+    return Nominatim(user_agent=user_agent)
@@ -0,0 +1,65 @@
+import csv
+import io
+
+
+class CopyStream(io.TextIOBase):
+    """
+    A read-only file-like object that serializes rows to CSV on demand.
+
+    `cursor.copy_expert` pulls the data with `read(size)`, so rows are consumed lazily
+    from the given iterable and only about `size` characters are kept in memory.
+    """
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        # None is written as an unquoted empty field, COPY's NULL in CSV format, while every
+        # other value is quoted, so that empty strings and any text stay values.
+        self._writer = csv.writer(
+            self._buffer, lineterminator="\n", quoting=csv.QUOTE_NOTNULL
+        )
+        # Number of rows serialized so far.
+        self.rows_count = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or self._buffer.tell() < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._writer.writerow(row)
+            self.rows_count += 1
+
+        data = self._buffer.getvalue()
+        if 0 <= size < len(data):
+            data, rest = data[:size], data[size:]
+        else:
+            rest = ""
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._buffer.write(rest)
+        return data
+
+
+def copy_rows(session, table, columns, rows):
+    """
+    Bulk load rows into a table with `COPY ... FROM STDIN` within the session transaction.
+
+    :param session: The SQLAlchemy session whose connection is used.
+    :param table: The name of the target table.
+    :param columns: The target column names, in the order of the row values.
+    :param rows: An iterable of tuples; it is consumed lazily while the data is streamed.
+    :return: The number of copied rows.
+    """
+    stream = CopyStream(rows)
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+            stream,
+        )
+    finally:
+        cursor.close()
+    return stream.rows_count
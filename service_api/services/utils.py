@@ -1,5 +1,39 @@
+import csv
+import shutil
+
 from service_api.constants import ALLOWED_EXTENSIONS
 
 
 def allowed_file(filename):
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, dot, extension = filename.rpartition(".")
+    return bool(dot) and extension.lower() in ALLOWED_EXTENSIONS
+
+
+def save_upload(file, save_path):
+    """
+    Write an uploaded file to disk in 1 MiB chunks, instead of the 16 KiB chunks
+    used by Werkzeug's `FileStorage.save`.
+    """
+    with open(save_path, "wb") as destination:
+        shutil.copyfileobj(file.stream, destination, length=1 << 20)
+
+
+def read_points(file_path):
+    """
+    Yield the (name, latitude, longitude) tuples of an uploaded points CSV file.
+    The columns are resolved once from the header, so each row is parsed as a plain list
+    instead of a dict, and the file is read through a 1 MiB buffer.
+    """
+    with open(
+        file_path, "r", encoding="utf-8", newline="", buffering=1 << 20
+    ) as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, None)
+        if header is None:
+            return
+        i_name = header.index("Point")
+        i_lat = header.index("Latitude")
+        i_lon = header.index("Longitude")
+        for row in reader:
+            if row:  # Skip blank lines, as csv.DictReader does.
+                yield row[i_name], float(row[i_lat]), float(row[i_lon])
@@ -1,32 +1,54 @@
-import csv
 import os
 
-from celery import Celery, chord
+import redis
+from celery import Celery, group
+from celery.signals import worker_process_init
 from flask import current_app
-from geoalchemy2.shape import to_shape
 from loguru import logger
-from sqlalchemy import text
-from sqlalchemy.orm import sessionmaker
-
-from service_api.models import db, Point, Distance, Task, TaskStatus, TaskType
-from service_api.services.geo import haversine_np, reverse_geocode
-
-
-def make_celery():
+from sqlalchemy import select
+
+from app import app
+from service_api.domain.calculate_distance import (
+    count_points,
+    distance_chunk_size,
+    get_max_distance,
+    insert_distances_numpy,
+    insert_distances_sql,
+)
+from service_api.domain.reverse_geocode import geocode_addresses, save_addresses
+from service_api.models import db, Point, Task, TaskStatus, TaskType
+from service_api.services.cache import (
+    count_done_chunk,
+    invalidate_result,
+    reset_done_chunks,
+)
+from service_api.services.geo import init_jit_worker
+from service_api.services.pgcopy import copy_rows
+from service_api.services.utils import read_points
+
+
+def make_celery(app):
     """
     Create and configure a Celery instance using the Flask application's configuration.
     This function ensures that all Celery tasks run within the Flask application context.
     """
-    from app import app
-
     celery = Celery(
         app.import_name,
         broker=app.config["CELERY_BROKER_URL"],
         backend=app.config["RESULT_BACKEND"],
     )
     celery.conf.update(app.config)
+    # Share a bounded pool of Redis connections between the tasks of a worker process
+    # instead of opening connections on demand.
+    celery.conf.update(
+        broker_pool_limit=app.config["CELERY_POOL_LIMIT"],
+        broker_transport_options={"max_connections": app.config["CELERY_POOL_LIMIT"]},
+        redis_max_connections=app.config["CELERY_POOL_LIMIT"],
+        redis_socket_keepalive=True,
+    )
 
     # Wrap each task to run within the Flask application context.
+    # A fresh context per task also tears down its scoped database session.
     class ContextTask(celery.Task):
         def __call__(self, *args, **kwargs):
             with app.app_context():
@@ -36,7 +58,18 @@ def make_celery():
     return celery
 
 
-celery_app = make_celery()
+celery_app = make_celery(app)
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    # Drop the pooled connections inherited from the parent process through fork,
+    # each worker process opens its own.
+    with app.app_context():
+        db.engine.dispose(close=False)
+    # Only the "numpy" distance backend runs the JIT kernel.
+    if app.config["DISTANCE_BACKEND"] == "numpy":
+        init_jit_worker()
 
 
 # ============================================================
@@ -68,6 +101,7 @@ def process_file_tasks(self):
     except Exception as e:
         logger.error(e)
         self.retry(exc=e, countdown=10)
+    invalidate_result(*ran_tasks)
 
 
 # ============================================================
@@ -76,8 +110,8 @@ def process_file_tasks(self):
 @celery_app.task(bind=True)
 def process_upload(self, upload_uuid):
     """
-    For a given upload_uuid, open the corresponding CSV file, read its rows,
-    and bulk insert the point records into the Point table.
+    For a given upload_uuid, open the corresponding CSV file and stream its rows
+    into the Point table with COPY.
     Once the points are inserted, launch tasks for reverse geocoding and for
     generating distance combinations.
     """
@@ -85,211 +119,179 @@ def process_upload(self, upload_uuid):
         file_path = os.path.join(
             current_app.config["UPLOAD_FOLDER"], f"{upload_uuid}.csv"
         )
-        points_to_insert = []
-        BATCH_SIZE = 1000
-
-        # Read CSV file row by row and accumulate points for bulk insertion.
-        with open(file_path, "r") as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                point_name = row["Point"]
-                lat = float(row["Latitude"])
-                lon = float(row["Longitude"])
-                # Store the geometry as WKT: "POINT(lon lat)" format.
-                points_to_insert.append(
-                    {
-                        "name": point_name,
-                        "geom": f"POINT({lon} {lat})",
-                        "upload_uuid": upload_uuid,
-                    }
-                )
-                if len(points_to_insert) >= BATCH_SIZE:
-                    db.session.bulk_insert_mappings(Point, points_to_insert)
-                    db.session.commit()
-                    points_to_insert = []
-            if points_to_insert:
-                db.session.bulk_insert_mappings(Point, points_to_insert)
-                db.session.commit()
+        # Stream the CSV rows straight into the Point table with COPY ... FROM STDIN.
+        # Rows are read and converted lazily while the data is sent, so memory stays
+        # constant regardless of the file size.
+        rows = (
+            (name, lat, lon, upload_uuid) for name, lat, lon in read_points(file_path)
+        )
+        points_count = copy_rows(
+            db.session, "point", ("name", "lat", "lon", "upload_uuid"), rows
+        )
+        db.session.commit()
 
         # Launch the reverse geocoding task (see below).
         reverse_geocode_points.delay(upload_uuid)
 
         # Launch the distance calculation task that generates combinations.
-        calculate_distances.delay(upload_uuid)
+        # The number of points is known from the COPY, so the pair ranges are
+        # computed without querying the points again.
+        calculate_distances.delay(upload_uuid, points_count)
 
     except Exception as e:
-        # On failure, mark the Task status as failed.
+        # On failure, discard the partially copied points and mark the Task status as failed.
+        db.session.rollback()
         Task.query.filter_by(upload_uuid=upload_uuid).update(
             {"status": TaskStatus.failed}
         )
         db.session.commit()
+        invalidate_result(upload_uuid)
         self.retry(exc=e, countdown=10)
 
 
 # ============================================================
-# Distance Calculation Task: Generate Distance Combinations and Process Them
+# Distance Calculation Task: Generate Distance Records for All Point Pairs
 # ============================================================
 @celery_app.task(bind=True)
-def calculate_distances(self, upload_uuid):
+def calculate_distances(self, upload_uuid, points_count=None):
     """
-    This task does the following:
-      1. Generates distance combination records by performing a self-join on the Point table
-         for points belonging to the given upload_uuid.
-      2. Paginates through these distance records in batches of 1,000.
-      3. For each batch, it spawns child tasks (calculate_distance_batch) to compute the actual distances.
-      4. Uses a chord to trigger a final callback (finalize_distance_calculations) once all child tasks complete.
+    This task generates the distance records for every unique pair of points of the given
+    upload_uuid with the backend selected by the DISTANCE_BACKEND setting:
+      - "sql" (default): a single INSERT ... SELECT where Postgres performs the self-join
+        and computes earth_distance, so none of the N*(N-1)/2 pair rows leave the database.
+        The distance Task is marked as completed in the same transaction.
+      - "numpy": the N*(N-1)/2 pairs are split into ranges of distance_chunk_size() pairs,
+        each computed on a worker by a calculate_distance_chunk child task. The chunks are
+        counted in Redis as they complete, and the last one triggers the final callback
+        (finalize_distance_calculations), so no child result goes through the result backend.
+        The ranges are derived from points_count, the points are only counted in the
+        database when it is not given.
+    When the upload has a max_distance, only the pairs within that distance are stored.
     """
     try:
-        # Insert distance combination records using a self-join on the Point table.
-        query = text("""
-            INSERT INTO distance (name_a, name_b, point_a, point_b, upload_uuid)
-            SELECT 
-                a.name AS name_a,
-                b.name AS name_b,
-                a.geom AS point_a,
-                b.geom AS point_b,
-                a.upload_uuid
-            FROM point a
-            JOIN point b ON a.id < b.id
-            WHERE a.upload_uuid = :upload_uuid;
-        """)
-        db.session.execute(query, {"upload_uuid": upload_uuid})
-        db.session.commit()
+        max_distance = get_max_distance(upload_uuid)
+        if current_app.config["DISTANCE_BACKEND"] == "numpy":
+            if points_count is None:
+                points_count = count_points(upload_uuid)
+            pairs_count = points_count * (points_count - 1) // 2
+            if pairs_count:
+                chunk_size = distance_chunk_size()
+                chunks_count = len(range(0, pairs_count, chunk_size))
+                chunk_tasks = [
+                    calculate_distance_chunk.s(
+                        upload_uuid,
+                        start,
+                        min(start + chunk_size, pairs_count),
+                        chunks_count,
+                        max_distance,
+                    )
+                    for start in range(0, pairs_count, chunk_size)
+                ]
+                # Run all child tasks in parallel, the last one to complete finalizes.
+                reset_done_chunks(upload_uuid)
+                group(chunk_tasks).apply_async()
+                return
+        else:
+            insert_distances_sql(upload_uuid, max_distance)
+        _complete_distance_task(upload_uuid)
     except Exception as e:
         self.retry(exc=e, countdown=10)
+    # Outside of the try: the distances are committed, they must not be inserted again.
+    invalidate_result(upload_uuid)
 
-    batch_size = 1000
-    last_id = 0
-    batch_tasks = []
 
-    # Paginate through the Distance records in batches.
-    while True:
-        batch = (
-            Distance.query.filter(
-                Distance.upload_uuid == upload_uuid, Distance.id > last_id
-            )
-            .order_by(Distance.id)
-            .limit(batch_size)
-            .all()
-        )
-        if not batch:
-            break
-        batch_ids = [record.id for record in batch]
-        last_id = batch_ids[-1]
-        # Append the signature of the child task for this batch.
-        batch_tasks.append(calculate_distance_batch.s(batch_ids))
+@celery_app.task(bind=True, ignore_result=True)
+def calculate_distance_chunk(
+    self, upload_uuid, start, stop, chunks_count, max_distance=None, inserted=False
+):
+    """
+    This child task computes the distances of the point pairs [start, stop) of the upload,
+    numbered in the row-major order of the upper triangle of the pair matrix, and stores them.
+    The pair distances are CPU-bound, so the chunks scale with the prefork worker concurrency.
+    The last of the chunks_count chunks of the upload to complete launches the final callback.
+    When only the counting of the chunk fails, the task is retried with `inserted` set,
+    so that the committed distances are not inserted again.
+    """
+    if not inserted:
+        try:
+            insert_distances_numpy(upload_uuid, start, stop, max_distance)
+            db.session.commit()
+        except Exception as e:
+            self.retry(exc=e, countdown=10)
 
-    if batch_tasks:
-        # Use a chord to run all child tasks in parallel and then finalize.
-        chord(batch_tasks)(finalize_distance_calculations.s(upload_uuid))
+    try:
+        done = count_done_chunk(upload_uuid, start)
+    except redis.RedisError as e:
+        self.retry(exc=e, countdown=10, kwargs={"inserted": True})
+    if done == chunks_count:
+        finalize_distance_calculations.delay(upload_uuid)
 
 
-@celery_app.task(bind=True)
-def calculate_distance_batch(self, batch_ids):
+@celery_app.task(bind=True, ignore_result=True)
+def finalize_distance_calculations(self, upload_uuid):
     """
-    This child task processes a batch of Distance records identified by their IDs.
-    For each record, it:
-      - Extracts the geometries for point_a and point_b.
-      - Computes the distance using the haversine_np function.
-      - Prepares an update mapping to update the record's distance field.
-    Finally, it performs a bulk update for the entire batch.
+    This callback task is triggered once all child tasks for distance calculation (calculate_distance_chunk)
+    have completed. It updates the overall Task record for distance calculations to 'completed'.
     """
-    Session = sessionmaker(bind=db.engine)
-    session = Session()
+    _complete_distance_task(upload_uuid)
+    invalidate_result(upload_uuid)
 
-    try:
-        records = session.query(Distance).filter(Distance.id.in_(batch_ids)).all()
-        update_mappings = []
-        for rec in records:
-            # Convert the stored geography to a Shapely geometry.
-            geom_a = to_shape(rec.point_a)
-            geom_b = to_shape(rec.point_b)
-            # Compute distance using haversine_np (inputs: lon, lat for each point).
-            distance = haversine_np(geom_a.x, geom_a.y, geom_b.x, geom_b.y)
-            update_mappings.append({"id": rec.id, "distance": distance})
-        if update_mappings:
-            session.bulk_update_mappings(Distance, update_mappings)
-            session.commit()
-    except Exception as e:
-        self.retry(exc=e, countdown=10)
-    finally:
-        session.close()
+
+def _complete_distance_task(upload_uuid):
+    Task.query.filter_by(
+        task_type=TaskType.distance,
+        status=TaskStatus.running,
+        upload_uuid=upload_uuid,
+    ).update(dict(status=TaskStatus.completed), synchronize_session=False)
+    db.session.commit()
 
 
 # ============================================================
-# Reverse Geocode Task: Process Points Sequentially Due to API Restrictions
+# Reverse Geocode Task: Process Points Concurrently Within API Rate Limits
 # ============================================================
 @celery_app.task(bind=True)
 def reverse_geocode_points(self, upload_uuid):
     """
-    For the given upload_uuid, this task processes all Point records in batches of 1,000.
-    For each point in a batch, it calls the reverse_geocode API sequentially (to respect API rate limits
-    and avoid simultaneous calls which may cause blocking) and accumulates the results.
-    After processing each batch, it performs a bulk update to store the addresses.
+    For the given upload_uuid, this task loads the (id, lat, lon) of all Point records and
+    processes them in batches of 1,000.
+    The points of a batch are reverse geocoded concurrently by reverse_geocode_batch, which bounds
+    the number of simultaneous requests and rate limits them to respect the API usage policy.
+    Points falling in a grid cell whose address is already cached are not geocoded again.
+    After processing each batch, it stores the addresses with COPY and a single UPDATE.
     Finally, it updates the Task status to completed.
     """
-    # Use a dedicated session for pagination to avoid issues with the scoped session.
-    Session = sessionmaker(bind=db.engine)
-    session = Session()
-
     task_status = TaskStatus.completed  # Default to 'completed'
     try:
         page_size = 1000
-        last_id = 0
-
-        while True:
-            # Retrieve a batch of Point records (selecting only id and geom)
-            batch = (
-                session.query(Point.id, Point.geom)
-                .filter(Point.upload_uuid == upload_uuid, Point.id > last_id)
-                .order_by(Point.id)
-                .limit(page_size)
-                .all()
-            )
-            if not batch:
-                break
-
-            update_mappings = []
-            for row in batch:
-                point_id, geom_val = row  # row is a tuple (id, geom)
-                shapely_geom = to_shape(geom_val)  # Convert to Shapely geometry
-                # Call reverse_geocode sequentially using (latitude, longitude)
-                address = reverse_geocode(shapely_geom.y, shapely_geom.x)
-                update_mappings.append({"id": point_id, "address": address})
-
-            if update_mappings:
-                session.bulk_update_mappings(Point, update_mappings)
-                session.commit()
+        # The coordinates are small enough to be loaded with one ordinary query. No cursor
+        # or transaction is kept open during the rate limited geocoding, which takes
+        # minutes per batch, so no snapshot holds back VACUUM in the meantime.
+        points = db.session.execute(
+            select(Point.id, Point.lat, Point.lon)
+            .where(Point.upload_uuid == upload_uuid)
+            .order_by(Point.id)
+        ).all()
+        db.session.commit()
 
-            last_id = batch[-1][
-                0
-            ]  # Update the cursor with the last processed point's id
+        for offset in range(0, len(points), page_size):
+            # Split the (id, lat, lon) rows into columns.
+            point_ids, lats, lons = zip(*points[offset : offset + page_size])
+            addresses = geocode_addresses(lats, lons)
+            save_addresses(point_ids, addresses)
+            db.session.commit()
     except Exception as e:
+        db.session.rollback()
         task_status = TaskStatus.failed
         raise
     finally:
         # Update the overall Task record to reflect the outcome of reverse geocoding.
-        session.query(Task).filter_by(
+        Task.query.filter_by(
             task_type=TaskType.reverse,
             status=TaskStatus.running,
             upload_uuid=upload_uuid,
-        ).update({"status": task_status})
-        session.commit()
-        session.close()
+        ).update({"status": task_status}, synchronize_session=False)
+        db.session.commit()
+        invalidate_result(upload_uuid)
 
     logger.info("Reverse geocode update completed for upload_uuid: {}", upload_uuid)
     return "Reverse geocode update completed"
-
-
-@celery_app.task(bind=True)
-def finalize_distance_calculations(self, results, upload_uuid):
-    """
-    This callback task is triggered once all child tasks for distance calculation (calculate_distance_batch)
-    have completed. It updates the overall Task record for distance calculations to 'completed'.
-    """
-    Task.query.filter_by(
-        task_type=TaskType.distance,
-        status=TaskStatus.running,
-        upload_uuid=upload_uuid,
-    ).update(dict(status=TaskStatus.completed))
-    db.session.commit()
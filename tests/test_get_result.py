@@ -0,0 +1,118 @@
+import uuid
+
+import orjson
+import pytest
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.orm import raiseload
+from sqlalchemy.schema import CreateTable
+
+from service_api.domain import get_result as get_result_module
+from service_api.domain.get_result import get_result
+from service_api.models import Distance, Point, Task, TaskStatus, TaskType, Upload, db
+from service_api.services.json_provider import OrjsonProvider
+
+# One statement for the upload and one per loaded collection (points, distances, tasks).
+MAX_STATEMENTS = 4
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """An application bound to an in-memory SQLite copy of the schema, without the cache."""
+    monkeypatch.setattr(
+        get_result_module, "get_cached_result", lambda upload_uuid: None
+    )
+    monkeypatch.setattr(get_result_module, "cache_result", lambda *args: None)
+    # SQLite only autoincrements single column primary keys, the ids are given below.
+    monkeypatch.setattr(Distance.__table__.c.id, "autoincrement", False)
+
+    app = Flask(__name__)
+    app.json = OrjsonProvider(app)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    db.init_app(app)
+    with app.app_context():
+        # The tables are created one by one, without the Postgres specific DDL
+        # (extensions, partitions and expression indexes) attached to the metadata.
+        with db.engine.begin() as connection:
+            for table in db.metadata.sorted_tables:
+                connection.execute(CreateTable(table))
+        yield app
+
+
+@pytest.fixture
+def upload_uuid(app):
+    upload_uuid = uuid.uuid4()
+    db.session.add(Upload(uuid=upload_uuid, filename="points.csv"))
+    db.session.add_all(
+        Point(id=i, name=name, lat=50.0 + i, lon=30.0, upload_uuid=upload_uuid)
+        for i, name in enumerate("ABC", start=1)
+    )
+    db.session.add_all(
+        Distance(id=i, point_a_id=a, point_b_id=b, distance=d, upload_uuid=upload_uuid)
+        for i, (a, b, d) in enumerate(((1, 2, 1.5), (1, 3, 2.5), (2, 3, 3.5)))
+    )
+    db.session.add_all(
+        [
+            Task(
+                status=TaskStatus.completed,
+                task_type=TaskType.reverse,
+                upload_uuid=upload_uuid,
+            ),
+            Task(
+                status=TaskStatus.running,
+                task_type=TaskType.distance,
+                upload_uuid=upload_uuid,
+            ),
+        ]
+    )
+    db.session.commit()
+    db.session.expunge_all()
+    return upload_uuid
+
+
+@pytest.fixture
+def statements(app):
+    """Forbid lazy loads and record the SQL statements sent to the database."""
+
+    def forbid_lazy_loads(orm_execute_state):
+        if orm_execute_state.is_select:
+            orm_execute_state.statement = orm_execute_state.statement.options(
+                raiseload("*")
+            )
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        recorded.append(statement)
+
+    recorded = []
+    event.listen(db.session, "do_orm_execute", forbid_lazy_loads)
+    event.listen(db.engine, "before_cursor_execute", record)
+    yield recorded
+    event.remove(db.engine, "before_cursor_execute", record)
+    event.remove(db.session, "do_orm_execute", forbid_lazy_loads)
+
+
+def test_get_result_loads_upload_in_bounded_statements(upload_uuid, statements):
+    payload = get_result(upload_uuid)
+
+    assert len(statements) <= MAX_STATEMENTS
+    result = orjson.loads(payload)
+    assert result["task_id"] == str(upload_uuid)
+    assert result["status"] == "running"
+    assert result["data"]["points"] == [
+        {"name": "A", "address": None},
+        {"name": "B", "address": None},
+        {"name": "C", "address": None},
+    ]
+    assert result["data"]["links"] == [
+        {"name": "AB", "distance": 1.5},
+        {"name": "AC", "distance": 2.5},
+        {"name": "BC", "distance": 3.5},
+    ]
+    assert result["statuses"] == {
+        "reverse_geocode": TaskStatus.completed,
+        "distance_task": TaskStatus.running,
+    }
+
+
+def test_get_result_unknown_upload(app, statements):
+    assert get_result(uuid.uuid4()) is None